@@ -1,3 +1,3 @@
 from .common import Architecture
-from .distribution import get_tarball, get_manifest, get_release_tarball_info, Variant
+from .distribution import get_tarball, get_tarballs, get_manifest, get_release_tarball_info, Variant
 from .sysroot import Sysroot
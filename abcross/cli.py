@@ -1,14 +1,18 @@
 import argparse
+import functools
 import logging
 import sys
 from pathlib import PosixPath
+from typing import List
 
 from .common import Architecture
 from .distribution import Variant, do_deploy
 from .sysroot import Sysroot
 
 
-def handle_arguments():
+@functools.cache
+def _parser() -> argparse.ArgumentParser:
+    """Build the argument parser. Built only once per process and reused by handle_arguments"""
     parser = argparse.ArgumentParser(description="AOSC OS cross-compiling sysroot manager")
     parser.add_argument("-a", "--arch",
                         required=True,
@@ -47,7 +51,8 @@ def handle_arguments():
     )
     subparser_deploy.add_argument(
         "-c", "--cache",
-        help="Save tarballs to ~/.cache/abcross/. Otherwise they are saved to tmpfs and deleted once we're done.",
+        help="Save tarballs and the release manifest to ~/.cache/abcross/ and reuse them next time. Otherwise "
+             "tarballs are streamed straight into tar and nothing is stored.",
         action="store_true"
     )
     subparser_enter = subparsers.add_parser("enter",
@@ -65,16 +70,26 @@ def handle_arguments():
         action="store_true",
         help="Do a full upgrade before unpacking specified packages"
     )
+    subparsers_unpack.add_argument(
+        "-r", "--refresh",
+        action="store_true",
+        help="Refresh source metadata even if it has been refreshed within the last hour"
+    )
     subparsers_unpack.add_argument(
         "packages",
         nargs='+',
         help="Space separated list of package names to install."
     )
-    return parser.parse_args()
+    return parser
+
+
+def handle_arguments(argv: List[str] | None = None):
+    return _parser().parse_args(argv)
 
 
 def main():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s', )
+    logging.raiseExceptions = False
     args = handle_arguments()
     a: Architecture = args.arch
     p: PosixPath = a.standard_sysroot() if args.sysroot is None else args.sysroot
@@ -83,7 +98,7 @@ def main():
         case "enter":
             s.containerize(args.argv, interactive=True)
         case "unpack":
-            s.unpack(args.packages, update=args.update)
+            s.unpack(args.packages, update=args.update, force_update=args.refresh)
         case _:
             sys.exit(do_deploy(s, args))
 
@@ -1,14 +1,19 @@
+import functools
 import logging
 import os
 import platform
 import re
+import shutil
 import subprocess
+import sys
 from enum import Enum
 from pathlib import PosixPath
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 
 logger = logging.getLogger("common")
 
+CACHE_DIR = PosixPath.home() / ".cache" / "abcross"
+
 
 class Architecture(Enum):
     """Hardware architecture supported by AOSC OS"""
@@ -28,36 +33,13 @@ class Architecture(Enum):
 
     def qemu_arch(self) -> str:
         """Return architecture name in qemu nomenclature"""
-        match self:
-            case Architecture.AMD64:
-                return "amd64"
-            case Architecture.ARM64:
-                return "aarch64"
-            case Architecture.LOONGSON3:
-                return "mips64el"
-            case Architecture.POWERPC:
-                return "ppc"
-            case Architecture.PPC64EL:
-                return "ppc64le"
-            case Architecture.RISCV64:
-                return "riscv64"
-            case Architecture.MIPS64R6EL:
-                return "mips64el"
-            case Architecture.ARMV4 | Architecture.ARMV6HF | Architecture.ARMV7HF:
-                return "arm"
-            case Architecture.M68K:
-                return "m68k"
-            case Architecture.PPC64:
-                return "ppc64"
-            case Architecture.I486:
-                return "i386"
-            case _:
-                raise ValueError
+        return _QEMU_ARCH[self]
 
     def qemu_bin(self) -> str:
-        return f"qemu-{self.qemu_arch()}-static"
+        return _QEMU_BIN[self]
 
     @staticmethod
+    @functools.cache
     def match_current_arch() -> Optional["Architecture"]:
         """Check whether current system architecture is any of the possible targets"""
         match platform.machine():
@@ -79,43 +61,102 @@ class Architecture(Enum):
 
     def have_qemu(self) -> str | None:
         """Return whether qemu static binary or none if this is not found on the system"""
-        base_name = self.qemu_bin()
-        binfmt_reg_name = f"/proc/sys/fs/binfmt_misc/qemu-{self.qemu_arch()}"
-        try:
-            with open(binfmt_reg_name, 'r') as binfmt_reg:
-                binfmt_reg_content = binfmt_reg.readlines()
-        except OSError as e:
-            logger.critical(f"Architecture {self} is not registered with binfmt: {e.strerror}")
-            return None
-        if binfmt_reg_content[0].strip() != "enabled":
-            logger.critical(f"Architecture {self} is not enabled with binfmt")
-            logger.critical(f"Content of binfmt descriptor:\n{binfmt_reg_content}")
-            return None
-        match_interp = re.match(f"interpreter (?P<path>.+{base_name})", binfmt_reg_content[1])
-        if not match_interp:
-            logger.critical(f"Architecture {self} does not have valid interpreter")
-            return None
-        path_interp = match_interp.group("path")
-        if PosixPath(path_interp).resolve().name != base_name:
-            logger.critical(f"Architecture {self} has incorrect interpreter {path_interp} instead of {base_name}")
-            return None
-        return path_interp
+        return _qemu_interpreter(self)
 
     def standard_sysroot(self) -> PosixPath:
         """Returns standard sysroot location for AOSC OS"""
-        return PosixPath(f"/var/ab/cross-root/{self.value}")
+        return _STANDARD_SYSROOT[self]
+
+
+_QEMU_ARCH: Dict[Architecture, str] = {
+    Architecture.AMD64: "amd64",
+    Architecture.ARM64: "aarch64",
+    Architecture.LOONGSON3: "mips64el",
+    Architecture.POWERPC: "ppc",
+    Architecture.PPC64EL: "ppc64le",
+    Architecture.RISCV64: "riscv64",
+    Architecture.MIPS64R6EL: "mips64el",
+    Architecture.ARMV4: "arm",
+    Architecture.ARMV6HF: "arm",
+    Architecture.ARMV7HF: "arm",
+    Architecture.M68K: "m68k",
+    Architecture.PPC64: "ppc64",
+    Architecture.I486: "i386",
+}
+_QEMU_BIN: Dict[Architecture, str] = {a: f"qemu-{n}-static" for a, n in _QEMU_ARCH.items()}
+_STANDARD_SYSROOT: Dict[Architecture, PosixPath] = {
+    a: PosixPath(f"/var/ab/cross-root/{a.value}") for a in Architecture
+}
+
+
+_INTERP_RE = re.compile(r"interpreter (?P<path>.+)")
+
+
+@functools.cache
+def _qemu_interpreter(arch: Architecture) -> str | None:
+    """
+    Look up binfmt registration of qemu for arch. binfmt registrations don't change under our feet, so the result is
+    cached for the lifetime of the process.
+    """
+    base_name = arch.qemu_bin()
+    binfmt_reg_name = f"/proc/sys/fs/binfmt_misc/qemu-{arch.qemu_arch()}"
+    try:
+        with open(binfmt_reg_name, 'r') as binfmt_reg:
+            binfmt_reg_content = binfmt_reg.readlines()
+    except OSError as e:
+        logger.critical("Architecture %s is not registered with binfmt: %s", arch, e.strerror)
+        return None
+    if binfmt_reg_content[0].strip() != "enabled":
+        logger.critical("Architecture %s is not enabled with binfmt", arch)
+        logger.critical("Content of binfmt descriptor:\n%s", binfmt_reg_content)
+        return None
+    match_interp = _INTERP_RE.match(binfmt_reg_content[1])
+    if not match_interp or not match_interp.group("path").strip().endswith(base_name):
+        logger.critical("Architecture %s does not have valid interpreter", arch)
+        return None
+    path_interp = match_interp.group("path").strip()
+    if PosixPath(path_interp).resolve().name != base_name:
+        logger.critical("Architecture %s has incorrect interpreter %s instead of %s", arch, path_interp, base_name)
+        return None
+    return path_interp
+
+
+def _run(argv: List[str], interactive: bool) -> (str, str, int):
+    """
+    Run argv to completion.
+
+    The executable is looked up in PATH up front and file descriptors are not closed, which lets CPython spawn the
+    child with posix_spawn instead of fork + exec. Nothing leaks into the child this way: fds opened by Python are
+    non-inheritable by default, and systemd-nspawn sanitizes what it passes into the container on its own.
+    """
+    executable = shutil.which(argv[0]) or argv[0]
+    result = subprocess.run(argv, executable=executable, close_fds=False,
+                            capture_output=not interactive, text=True)
+    return result.stdout, result.stderr, result.returncode
+
+
+@functools.cache
+def privileged_prefix() -> Tuple[str, ...]:
+    """argv prefix that runs a command as root: sudo, or nothing when we already are root"""
+    return ("sudo",) if os.geteuid() != 0 else ()
 
 
 def privileged_call(argv: List[str], interactive: bool) -> (str, str, int):
-    need_sudo = os.geteuid() != 0
-    call_args = ["sudo"] if need_sudo else []
+    call_args = [*privileged_prefix(), *argv]
+    if call_args[0] == "sudo":
+        logger.info("!!! About to run %s", call_args)
+    return _run(call_args, interactive)
+
+
+def privileged_python(snippet: str, argv: List[str], interactive: bool = False) -> (str, str, int):
+    """
+    Run a python snippet with root privilege. argv is passed to the snippet as sys.argv[1:].
+    Several filesystem operations can be bundled this way, paying for sudo and process startup only once.
+    """
+    call_args = [sys.executable, "-I", "-c", snippet]
     call_args.extend(argv)
-    if need_sudo:
-        logger.info(f"!!! About to run {call_args}")
-    result = subprocess.run(call_args, capture_output=not interactive, text=True)
-    return result.stdout, result.stderr, result.returncode
+    return privileged_call(call_args, interactive=interactive)
 
 
 def regular_call(argv: List[str], interactive: bool) -> (str, str, int):
-    result = subprocess.run(argv, capture_output=not interactive, text=True)
-    return result.stdout, result.stderr, result.returncode
+    return _run(argv, interactive)
@@ -1,22 +1,46 @@
-import json
+import hashlib
 import logging
+import os
 import shutil
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from operator import itemgetter
 from pathlib import PosixPath
-from typing import Dict, Any, List
-from urllib.parse import urlparse, urlunparse
-from urllib.request import urlopen
+from typing import Dict, Any, List, BinaryIO
+from urllib.error import HTTPError
+from urllib.request import urlopen, Request
 
-from .common import Architecture, privileged_call
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+from .common import Architecture, CACHE_DIR, privileged_call, privileged_python
 from .sysroot import Sysroot
-from .tar import download_tarball, extract_tarball
+from .tar import download_tarball, open_tarball_stream, open_local_tarball_stream, extract_tarball_stream
 
 RELEASE_URL_BASE = "/aosc-os/"
-CACHE_DIR = PosixPath.home() / ".cache" / "abcross"
+SUPPORTED_URL_SCHEMES = ("http://", "https://", "file://")
+# Upper bound of tarballs being fetched at the same time by get_tarballs
+MAX_PARALLEL_DOWNLOADS = 8
 
 logger = logging.getLogger("distribution")
 
+# Run by privileged_python: move the old sysroot at argv[1] aside to argv[2], or delete it if it can't be moved.
+# Then make sure an empty sysroot directory exists.
+_PREPARE_SYSROOT = """
+import os, shutil, sys
+path, stale = sys.argv[1:3]
+if stale:
+    try:
+        os.rename(path, stale)
+    except OSError:
+        shutil.rmtree(path)
+        print("deleted")
+os.makedirs(path, exist_ok=True)
+"""
+_REMOVE_TREE = "import shutil, sys; shutil.rmtree(sys.argv[1])"
+
 
 class Variant(Enum):
     """
@@ -33,19 +57,69 @@ class Variant(Enum):
     X11 = "X11"  # X11 retro
 
 
-def get_manifest(mirror: str = "https://repo.aosc.io/") -> Dict[str, Any]:
-    """Download manifest from mirror and deserialize"""
+def get_manifest(mirror: str = "https://repo.aosc.io/", cache: bool = False) -> Dict[str, Any]:
+    """
+    Download manifest from mirror and deserialize. With cache, the manifest is kept in CACHE_DIR and only downloaded
+    again once it changed on the mirror.
+    """
     # Validate mirror
     manifest_url_string = mirror + RELEASE_URL_BASE + "/manifest/recipe.json"
-    manifest_url = urlparse(manifest_url_string)
-    match manifest_url.scheme:
-        case "http" | "https" | "file":
-            pass
-        case _:
-            raise ValueError("Manifest URL is invalid")
+    if not manifest_url_string.startswith(SUPPORTED_URL_SCHEMES):
+        raise ValueError("Manifest URL is invalid")
+    if not cache:
+        # Fetch manifest. urlopen or json load may throw
+        with urlopen(manifest_url_string) as manifest:
+            return _json.loads(manifest.read())
+    # Revalidate the copy from last time if we have one, so that an unchanged manifest is not downloaded again
+    cached_manifest = CACHE_DIR / f"recipe-{hashlib.sha256(mirror.encode()).hexdigest()[:16]}.json"
+    cached_etag = cached_manifest.with_name(cached_manifest.name + ".etag")
+    request = Request(manifest_url_string)
+    if cached_manifest.is_file() and cached_etag.is_file():
+        request.add_header("If-None-Match", cached_etag.read_text())
     # Fetch manifest. urlopen or json load may throw
-    with urlopen(urlunparse(manifest_url)) as manifest:
-        return json.load(manifest)
+    try:
+        body, etag = _fetch_manifest(request)
+    except HTTPError as e:
+        if e.code != 304:
+            raise
+        try:
+            cached = _json.loads(cached_manifest.read_bytes())
+        except (OSError, ValueError):
+            # Don't fail the deployment over a broken cache. Drop it and ask for the manifest unconditionally.
+            logger.warning("Cached manifest %s is unreadable. Downloading it again.", cached_manifest)
+            cached_etag.unlink(missing_ok=True)
+            cached_manifest.unlink(missing_ok=True)
+            body, etag = _fetch_manifest(Request(manifest_url_string))
+        else:
+            logger.info("Manifest has not changed since last download. Using cached copy.")
+            return cached
+    if etag is not None:
+        # Body goes first. Interrupted in between, the old etag next to the new body just makes the next request
+        # download it again, while a new etag next to an old or partial body would have it served as is on 304.
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            _write_atomic(cached_manifest, body)
+            _write_atomic(cached_etag, etag.encode())
+        except OSError as e:
+            logger.debug("Cannot cache manifest at %s: %s", cached_manifest, e.strerror)
+    return _json.loads(body)
+
+
+def _fetch_manifest(request: Request) -> (bytes, str | None):
+    """Return manifest body and its ETag if the server gave one"""
+    with urlopen(request) as manifest:
+        return manifest.read(), manifest.headers.get("ETag")
+
+
+def _write_atomic(path: PosixPath, data: bytes) -> None:
+    """Replace the file at path with data, so that readers see either the old or the new content in whole"""
+    temp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        temp.write_bytes(data)
+        os.replace(temp, path)
+    except OSError:
+        temp.unlink(missing_ok=True)
+        raise
 
 
 def get_release_tarball_info(manifest: Dict[str, Any],
@@ -57,27 +131,12 @@ def get_release_tarball_info(manifest: Dict[str, Any],
     """
     if "variants" not in manifest:
         raise ValueError("Malformed manifest: This stuff doesn't have variants list")
-    variants_list: List[Dict[str, Any]] = manifest["variants"]
-    # Try to find the variant we want
-    tarballs_per_variant: Dict[Variant, List[Dict]] = {}
-    for variant_releases in variants_list:
-        released_variant = Variant(variant_releases["name"])
-        if released_variant not in tarballs_per_variant:
-            tarballs_per_variant[released_variant] = []
-        if "tarballs" not in variant_releases:
-            continue
-        for tarball in variant_releases["tarballs"]:
-            tarballs_per_variant[released_variant].append(tarball)
-    if variant not in tarballs_per_variant:
-        return None
-    tarballs = tarballs_per_variant[variant]
-    # Find releases for the correct architecture
-    tarballs_arch = [tarball for tarball in tarballs if Architecture(tarball["arch"]) == architecture]
-    if len(tarballs_arch) == 0:
-        return None
+    # Single pass over the manifest, only looking at tarballs of the variant and architecture we want
+    candidates = (tarball
+                  for variant_releases in manifest["variants"] if variant_releases["name"] == variant.value
+                  for tarball in variant_releases.get("tarballs", ()) if tarball["arch"] == architecture.value)
     # Find the latest release
-    latest_release = max(tarballs_arch, key=lambda t: t["date"])
-    return latest_release
+    return max(candidates, key=itemgetter("date"), default=None)
 
 
 def get_tarball(tarball_info: Dict[str, int | str],
@@ -85,67 +144,133 @@ def get_tarball(tarball_info: Dict[str, int | str],
                 mirror: str = "https://repo.aosc.io/",
                 overwrite: bool = True
                 ) -> PosixPath:
-    """Download tarball to specified directory, may throw exception if tarball cannot be found."""
+    """
+    Download tarball to specified directory, may throw exception if tarball cannot be found.
+    dest_dir is used as given. Callers resolve it beforehand.
+    """
     download_url_str: str = mirror + RELEASE_URL_BASE + tarball_info["path"]
-    download_url = urlparse(download_url_str)
     expected_sum = tarball_info["sha256sum"]
     tarball_basename = PosixPath(tarball_info["path"]).name
-    tarball_save_path = dest_dir.resolve() / tarball_basename
+    tarball_save_path = dest_dir / tarball_basename
     if overwrite or not tarball_save_path.exists():
         shutil.rmtree(tarball_save_path, ignore_errors=True)
-        download_tarball(urlunparse(download_url), tarball_save_path, expected_sum)
+        download_tarball(download_url_str, tarball_save_path, expected_sum)
         return tarball_save_path
     # If no overwrite and the tarball path exists - most likely we've downloaded this before
-    logger.info(f"Found previously downloaded tarball {tarball_save_path}. Reusing.")
+    logger.info("Found previously downloaded tarball %s. Reusing.", tarball_save_path)
     return tarball_save_path
 
 
+def get_tarball_stream(tarball_info: Dict[str, int | str],
+                       mirror: str = "https://repo.aosc.io/"
+                       ) -> BinaryIO:
+    """
+    Open tarball for streaming without saving it. Reading to the end raises RuntimeError on checksum mismatch.
+    """
+    download_url_str: str = mirror + RELEASE_URL_BASE + tarball_info["path"]
+    return open_tarball_stream(download_url_str, tarball_info["sha256sum"])
+
+
+def get_tarballs(tarball_infos: List[Dict[str, int | str]],
+                 dest_dir: PosixPath,
+                 mirror: str = "https://repo.aosc.io/",
+                 overwrite: bool = True
+                 ) -> List[PosixPath]:
+    """
+    Download multiple tarballs to specified directory concurrently.
+
+    Downloads are network bound, so each tarball is fetched on its own connection from a bounded thread pool.
+    Paths are returned in the same order as tarball_infos. Exception from any download is re-raised.
+    """
+    if len(tarball_infos) == 0:
+        return []
+    workers = min(MAX_PARALLEL_DOWNLOADS, len(tarball_infos))
+    dest_dir = dest_dir.resolve()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(get_tarball, info, dest_dir, mirror, overwrite) for info in tarball_infos]
+        return [future.result() for future in futures]
+
+
 def do_deploy(s: Sysroot, args) -> int:
     """Deploy specified sysroot"""
-    manifest = get_manifest(args.mirror)
+    manifest = get_manifest(args.mirror, cache=args.cache)
     tarball = get_release_tarball_info(manifest, s.arch, args.variant)
     if tarball is None:
-        logger.error(f"Selected architecture {s.arch} and variant {args.variant} does not have a tarball available!")
+        logger.error("Selected architecture %s and variant %s does not have a tarball available!", s.arch, args.variant)
         return 1
-    logger.info(f"Selected distribution for {s.arch} variant {args.variant}:")
-    logger.info("\tRelease Date:  %s" % (tarball["date"]))
-    logger.info("\tDownload Size: %d Bytes" % (tarball["downloadSize"]))
-    logger.info("\tOn-Disk Size:  %d Bytes" % (tarball["instSize"]))
+    logger.info("Selected distribution for %s variant %s:", s.arch, args.variant)
+    logger.info("\tRelease Date:  %s", tarball["date"])
+    logger.info("\tDownload Size: %d Bytes", tarball["downloadSize"])
+    logger.info("\tOn-Disk Size:  %d Bytes", tarball["instSize"])
 
     # Pre-download check...
+    stale_sysroot: PosixPath | None = None
     if s.path.is_dir() and next(s.path.iterdir(), None) is not None:
         if not args.force:
-            logger.error(f"Destination sysroot {s.path} is not empty. Refusing to overwrite.")
+            logger.error("Destination sysroot %s is not empty. Refusing to overwrite.", s.path)
             return 1
-        else:
-            logger.info(f"You asked for force-redeploy... Deleting existing sysroot.")
-            _, _, ret = privileged_call(["rm", "-rf", s.path], interactive=False)
-            if ret != 0:
-                logger.error(f"Cannot delete non-empty sysroot {s.path}. You are on your own.")
-                return 2
-            logger.info(f"Old sysroot {s.path} has been deleted.")
-    if not s.path.exists():
-        _, _, ret = privileged_call(["mkdir", "-p", s.path], interactive=False)
+        logger.info("You asked for force-redeploy... Moving existing sysroot out of the way.")
+        # Renaming is instant on the same filesystem. The old tree is then deleted while the new tarball downloads.
+        stale_sysroot = s.path.with_name(f".{s.path.name}.abcross-old-{os.getpid()}")
+    if stale_sysroot is not None or not s.path.exists():
+        # Clearing out the old sysroot and creating the new one is done in a single privileged call
+        out, _, ret = privileged_python(_PREPARE_SYSROOT, [s.path, stale_sysroot or ""])
         if ret != 0:
-            logger.error(f"Cannot create empty sysroot {s.path}. You are on your own.")
+            logger.error("Cannot prepare empty sysroot %s. You are on your own.", s.path)
             return 2
+        if out.strip() == "deleted":
+            stale_sysroot = None
+            logger.info("Old sysroot %s has been deleted.", s.path)
+    with ThreadPoolExecutor(max_workers=1) as cleaner:
+        removal = None
+        if stale_sysroot is not None:
+            removal = cleaner.submit(privileged_python, _REMOVE_TREE, [stale_sysroot])
+        try:
+            return _fetch_and_extract(s, args, tarball)
+        finally:
+            # Reported even if deployment failed: the stale tree is a whole sysroot worth of disk space
+            if removal is not None:
+                try:
+                    _, _, removal_ret = removal.result()
+                except OSError:
+                    removal_ret = -1
+                if removal_ret != 0:
+                    logger.warning("Cannot delete old sysroot at %s. Please remove it manually.", stale_sysroot)
+                else:
+                    logger.info("Old sysroot %s has been deleted.", stale_sysroot)
+
+
+def _fetch_and_extract(s: Sysroot, args, tarball: Dict[str, int | str]) -> int:
+    """Download the tarball for deployment and extract it into an empty sysroot"""
     # Find local cache if needed
-    download_path = PosixPath()
     if args.cache:
-        if CACHE_DIR.exists() and CACHE_DIR.is_dir():
-            download_path = CACHE_DIR.resolve()
-            logger.info(f"Downloading tarball to {CACHE_DIR}")
-        else:
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            logger.warning("Cache directory %s is not available. Tarball will not be cached.", CACHE_DIR)
+            args.cache = False
+    cached_tarball = CACHE_DIR.resolve() / PosixPath(tarball["path"]).name if args.cache else None
+    try:
+        if cached_tarball is not None and cached_tarball.exists():
+            # The cached copy is checksummed while tar consumes it, not in a separate pass before extraction.
+            logger.info("Found previously downloaded tarball %s. Reusing.", cached_tarball)
             try:
-                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                with open_local_tarball_stream(cached_tarball, tarball["sha256sum"]) as stream:
+                    extract_tarball_stream(stream, tarball["path"], s.path, silent=False)
             except RuntimeError:
-                logger.warning(f"Cache directory {CACHE_DIR} is not available. Writing to tmpfs.")
-                args.cache = False
-    if not args.cache:
-        download_path = PosixPath(tempfile.mkdtemp(prefix="abcross-tarball-"))
-    local_tarball = get_tarball(tarball, download_path, args.mirror, overwrite=False)
-    extract_tarball(local_tarball, s.path, silent=False)
-    logger.info(f"Sysroot for {s.arch} is now ready for use at {s.path}")
-    if not args.cache:
-        shutil.rmtree(download_path, ignore_errors=True)
+                logger.error("Cached tarball %s is corrupted. Removing it from cache.", cached_tarball)
+                cached_tarball.unlink(missing_ok=True)
+                raise
+        else:
+            # Extract as bytes arrive instead of waiting for the download to finish.
+            # Without caching the tarball never touches the disk.
+            if cached_tarball is not None:
+                logger.info("Downloading tarball to %s", CACHE_DIR)
+            with get_tarball_stream(tarball, args.mirror) as stream:
+                extract_tarball_stream(stream, tarball["path"], s.path, silent=False, save_as=cached_tarball)
+    except Exception:
+        logger.error("Deployment failed. Removing partially extracted sysroot %s.", s.path)
+        privileged_call(["rm", "-rf", s.path], interactive=False)
+        raise
+    logger.info("Sysroot for %s is now ready for use at %s", s.arch, s.path)
     return 0
@@ -1,13 +1,74 @@
+import json
 import logging
+import os
+import re
+import shlex
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import PosixPath
-from typing import List
+from typing import List, Dict, Tuple
+from urllib.request import urlopen, Request
 
 from .common import Architecture, privileged_call, regular_call
+from .tar import Progress, download_tarball
 
 logger = logging.getLogger("sysroot")
 
+# Seconds after which APT source metadata in a sysroot is considered stale and refreshed before unpacking
+APT_LISTS_MAX_AGE = 3600
+# Written inside the sysroot by the in-container apt script only after apt update succeeded, relative to its root.
+# It holds the InRelease validators the refresh was done against. Living in the sysroot, it goes away with the tree.
+_UPDATE_STAMP = "var/lib/apt/abcross-update-stamp"
+# Seconds to wait for a source to answer whether its InRelease changed. No answer means apt update has to run.
+VALIDATOR_TIMEOUT = 10
+# Exit status of the in-container apt script when full-upgrade fails
+_UPGRADE_FAILED = 42
+# Exit status of the in-container apt script when apt update fails but everything else went fine
+_UPDATE_FAILED = 43
+# Number of packages downloaded at the same time, unless overridden by ABCROSS_FETCH_THREADS
+FETCH_THREADS = 8
+# A one-line style APT source: deb [options] uri suite [components...]
+_SOURCES_LINE_RE = re.compile(r"^\s*deb\s+(?:\[[^]]*]\s+)?(?P<uri>\S+)\s+(?P<suite>\S+)")
+# A line of "apt-get --print-uris" output: 'uri' file-name size hash-type:hash. apt prints the strongest hash it has.
+_PRINT_URIS_RE = re.compile(r"^'(?P<uri>[^']+)' (?P<name>\S+) \d+ ?(?:(?P<hash_type>\w+):(?P<hash>[0-9a-fA-F]+))?$")
+# Hash types of apt that packages are verified with, and their hashlib names. Weaker ones are refused.
+_APT_HASHES = {"SHA512": "sha512", "SHA256": "sha256"}
+
+
+def _fetch_threads() -> int:
+    """Number of parallel downloads, from ABCROSS_FETCH_THREADS if it holds a positive number"""
+    value = os.environ.get("ABCROSS_FETCH_THREADS")
+    if value is None:
+        return FETCH_THREADS
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        logger.warning("Ignoring ABCROSS_FETCH_THREADS=%s, not a positive number. Using %d.", value, FETCH_THREADS)
+        return FETCH_THREADS
+    return threads
+
+
+def _parse_print_uris(out: str) -> List[Tuple[str, str, str, str]]:
+    """
+    Parse "apt-get --print-uris" output into (uri, file name, hashlib algorithm, hex digest) per package. Raise
+    OSError on lines that cannot be parsed or packages without a supported hash: they would be skipped or
+    installed unverified otherwise.
+    """
+    downloads = []
+    for line in filter(None, out.splitlines()):
+        m = _PRINT_URIS_RE.match(line)
+        if m is None:
+            raise OSError(f"Cannot understand apt download list entry: {line}")
+        algorithm = _APT_HASHES.get(m.group("hash_type"))
+        if algorithm is None:
+            raise OSError(f"No SHA256 or SHA512 checksum known for {m.group('name')}. Refusing to install it.")
+        downloads.append((m.group("uri"), m.group("name"), algorithm, m.group("hash").lower()))
+    return downloads
+
 
 @dataclass
 class Sysroot:
@@ -15,6 +76,14 @@ class Sysroot:
     arch: Architecture
     path: PosixPath
 
+    def __post_init__(self):
+        # Resolve once here so that later calls don't walk symlinks over and over again
+        self.path = PosixPath(self.path).resolve()
+        # String form for building argv and os.path calls, so they don't go through PosixPath.__str__ every time
+        self._path_str = os.fspath(self.path)
+        # Invariant head of every systemd-nspawn call into this sysroot
+        self._nspawn_base = ["systemd-nspawn", f"--hostname=abcross-{self.arch.value}", "-D", self._path_str]
+
     def dpkg_call(self, argv: List[str],
                   containerize: bool = False,
                   sudo: bool = True,
@@ -31,7 +100,7 @@ class Sysroot:
         """
         dpkg_call = ["dpkg"]
         if not containerize:
-            dpkg_call.append(f"--root={self.path}")
+            dpkg_call.append(f"--root={self._path_str}")
         dpkg_call.extend(argv)
 
         if containerize:
@@ -44,9 +113,11 @@ class Sysroot:
                  containerize: bool = True,
                  sudo: bool = True,
                  interactive: bool = False,
-                 nspawn_args: List[str] = None) -> (str, str, int):
+                 nspawn_args: List[str] = None,
+                 apt_binary: str = "apt") -> (str, str, int):
         """
         Call apt into the sysroot
+        :param apt_binary: apt frontend to call. Use "apt-get" when output is parsed.
         :param interactive: whether this call should be interactive
         :param nspawn_args:  extra arguments to pass to nspawn
         :param argv: dpkg arguments
@@ -54,14 +125,22 @@ class Sysroot:
         :param containerize: whether this call should be executed inside qemu from the container
         :return: stdout, stderr, exit code
         """
-        apt_call = ["apt"]
-        if not containerize:
-            apt_call.extend(["-o", f"RootDir={self.path}"])
-        apt_call.extend(argv)
-
         if containerize:
-            return self.containerize(apt_call, interactive=interactive, nspawn_args=nspawn_args)
-        else:
+            return self.containerize([apt_binary, *argv], interactive=interactive, nspawn_args=nspawn_args)
+        # Host apt working on the sysroot. apt reads APT_CONFIG before anything else, so with Dir and Dir::Etc set there
+        # apt.conf.d and sources are taken from the sysroot and the host configuration is never read. The paths
+        # resolution depends on are given again on the command line, which wins over any configuration file.
+        # Dir rather than RootDir: RootDir would also be prepended to absolute paths given in other options.
+        with tempfile.NamedTemporaryFile("w", prefix="abcross-apt-", suffix=".conf") as apt_config:
+            apt_config.write(f'Dir "{self._path_str}/";\nDir::Etc "{self._path_str}/etc/apt/";\n')
+            apt_config.flush()
+            apt_call = ["env", f"APT_CONFIG={apt_config.name}", apt_binary,
+                        "-o", f"Dir={self._path_str}/",
+                        "-o", f"Dir::Etc={self._path_str}/etc/apt/",
+                        "-o", f"Dir::State={self._path_str}/var/lib/apt/",
+                        "-o", f"Dir::State::status={self._path_str}/var/lib/dpkg/status",
+                        "-o", f"Dir::Cache={self._path_str}/var/cache/apt/",
+                        *argv]
             return privileged_call(apt_call, interactive=interactive) \
                 if sudo else regular_call(apt_call, interactive=interactive)
 
@@ -82,13 +161,10 @@ class Sysroot:
             argv = ["/bin/sh"]
         # Checks if we can execute stuff in this Sysroot...
         if not self.arch.match_current_arch() and not self.arch.have_qemu():
-            logger.error(f"You can't run program built for {self.arch}. Install {self.arch.qemu_bin()} first.")
+            logger.error("You can't run program built for %s. Install %s first.", self.arch, self.arch.qemu_bin())
             return None
         # Form systemd-nspawn call.
-        container_call = [
-            "systemd-nspawn", f"--hostname=abcross-{self.arch.value}",
-            "-D", self.path.resolve(),
-        ]
+        container_call = self._nspawn_base.copy()
         if nspawn_args:
             container_call.extend(nspawn_args)
         container_call.append("--as-pid2")
@@ -96,7 +172,64 @@ class Sysroot:
 
         return privileged_call(container_call, interactive=interactive)
 
-    def unpack(self, packages: List[str], update: bool = False) -> None:
+    def apt_lists_fresh(self) -> bool:
+        """Whether APT source metadata in the sysroot has been refreshed within APT_LISTS_MAX_AGE seconds"""
+        # Not lists/partial: a failed apt update touches it as well, and one where nothing changed may not.
+        try:
+            last_update = os.stat(os.path.join(self._path_str, _UPDATE_STAMP)).st_mtime
+        except OSError:
+            return False
+        return time.time() - last_update < APT_LISTS_MAX_AGE
+
+    def _inrelease_validators(self) -> Dict[str, str] | None:
+        """
+        Ask every APT source of the sysroot for the ETag (or Last-Modified) of its InRelease file, with HEAD requests
+        in parallel. Return None if some source cannot be checked this way or does not answer within
+        VALIDATOR_TIMEOUT, in which case apt update must not be skipped.
+        """
+        sources_list_d = self.path / "etc/apt/sources.list.d"
+        if any(sources_list_d.glob("*.sources")):
+            # deb822 style sources are not parsed here
+            return None
+        urls: List[str] = []
+        for sources_list in [self.path / "etc/apt/sources.list", *sorted(sources_list_d.glob("*.list"))]:
+            try:
+                lines = sources_list.read_text().splitlines()
+            except FileNotFoundError:
+                continue
+            except OSError:
+                return None
+            for match in filter(None, map(_SOURCES_LINE_RE.match, lines)):
+                if match.group("suite").endswith("/"):
+                    # Flat repository without dists/
+                    return None
+                urls.append(f"{match.group('uri').rstrip('/')}/dists/{match.group('suite')}/InRelease")
+        if not urls:
+            return None
+
+        def validator(url: str) -> str | None:
+            try:
+                with urlopen(Request(url, method="HEAD"), timeout=VALIDATOR_TIMEOUT) as head:
+                    return head.headers.get("ETag") or head.headers.get("Last-Modified")
+            except OSError:
+                # Timeouts included
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(len(urls), _fetch_threads())) as executor:
+            validators = dict(zip(urls, executor.map(validator, urls)))
+        if None in validators.values():
+            return None
+        return validators
+
+    def _saved_validators(self) -> Dict[str, str] | None:
+        """InRelease validators saved in the sysroot by the last successful apt update"""
+        try:
+            with open(os.path.join(self._path_str, _UPDATE_STAMP)) as stamp:
+                return json.load(stamp)
+        except (OSError, ValueError):
+            return None
+
+    def unpack(self, packages: List[str], update: bool = False, force_update: bool = False) -> None:
         """
         Unpacks a list of deb packages into the sysroot. By "unpacking" I mean literally unpacking only. This operation
         will NOT maintain dependency consistency NOR trigger post-install configuration.
@@ -106,58 +239,108 @@ class Sysroot:
 
         :param update:
         Whether sysroot should be fully upgraded before unpacking over it - note: this step is likely to fail.
+        :param force_update:
+        Whether APT source metadata should be refreshed even if it is recent or the sources have not changed.
         :param packages: the list of names of packages to install.
         :return: None - if error occurs exception will be thrown.
         """
-        dpkg_admin_dir = (self.path / "var/lib/dpkg").resolve()
-        # Sanity check: admin dir must exist and is a directory.
-        if not dpkg_admin_dir.is_dir():
+        dpkg_admin_dir = os.path.join(self._path_str, "var/lib/dpkg")
+        # Sanity check: admin dir must exist and is a directory. A single stat, no symlink resolution needed.
+        if not os.path.isdir(dpkg_admin_dir):
             raise EnvironmentError(f"{dpkg_admin_dir} in sysroot doesn't exist or is not a directory.")
-        # Before this we need to refresh APT sources inside the container...
-        logger.info("Refreshing source metadata...")
-        _, _, ret = self.apt_call(["update", "-yy"], containerize=True, interactive=True)
+        # Refresh and upgrade run in one container session, so that systemd-nspawn only starts up once.
+        # Before downloading we need to refresh APT sources inside the container... unless that has just been done, or
+        # the sources haven't changed since the last refresh.
+        apt_steps = []
+        validators = None
+        if force_update or update or not self.apt_lists_fresh():
+            validators = self._inrelease_validators()
+            refresh = force_update or update or validators is None or validators != self._saved_validators()
+        else:
+            refresh = False
+        if refresh:
+            logger.info("Refreshing source metadata...")
+            stamp = shlex.quote(json.dumps(validators) if validators is not None else "")
+            apt_steps.append(f"apt update -yy && printf %s {stamp} > /{_UPDATE_STAMP} "
+                             f"|| update_status={_UPDATE_FAILED}")
+        else:
+            logger.info("Source metadata is up to date. Skipping refresh.")
         if update:
             logger.info("You have requested full system upgrade...")
-            _, _, ret = self.apt_call(["full-upgrade", "-yy", "-o", "Dpkg::Options::=--force-confnew"],
-                                      containerize=True, interactive=True)
+            apt_steps.append(f"apt full-upgrade -yy -o Dpkg::Options::=--force-confnew || exit {_UPGRADE_FAILED}")
+        if apt_steps:
+            apt_steps.append("exit ${update_status:-0}")
+            result = self.containerize(["/bin/sh", "-c", "\n".join(apt_steps)], interactive=True)
+            if result is None:
+                raise OSError("Cannot run apt in the sysroot.")
+            _, _, ret = result
+            if ret == _UPGRADE_FAILED:
+                raise OSError("Cannot upgrade in the sysroot. You may need to manually correct this problem.")
+            if ret == _UPDATE_FAILED:
+                logger.warning("Cannot refresh source metadata. Carrying on with what the sysroot has.")
+            elif ret != 0:
+                # nspawn failing to start, no /bin/sh in the sysroot, killed by a signal...
+                raise OSError(f"Cannot run apt in the sysroot. Container exited with {ret}.")
+        # Debs are fetched by this process rather than apt in the container, so the directory belongs to us and is
+        # removed in-process on the way out, success or not.
+        with tempfile.TemporaryDirectory(prefix="abcross-download-") as temp_download_dir:
+            # Download those packages. Nothing gets executed for this, so host apt resolves them against the
+            # sysroot's sources and dpkg status without spinning up a container. The files are then fetched in
+            # parallel by urllib. Unlike apt's own acquire step, that does not follow Acquire::*::Proxy or auth.conf
+            # of the sysroot: mirrors needing either are not supported here. http_proxy / https_proxy are honored.
+            logger.info("Resolving packages...")
+            # apt leaves out debs it finds complete in its archives directory. Pointed at the empty download
+            # directory, it lists every package, instead of skipping those cached in the sysroot's
+            # var/cache/apt/archives which would then never be handed to dpkg.
+            uris_args = ["install", "--print-uris", "-qq", "-o", f"APT::Architecture={self.arch.value}",
+                         "-o", f"Dir::Cache::archives={temp_download_dir}/"]
+            uris_args.extend(packages)
+            out, err, ret = self.apt_call(uris_args, containerize=False, sudo=True, interactive=False,
+                                          apt_binary="apt-get")
             if ret != 0:
-                raise OSError(f"Cannot upgrade in the sysroot. Apt returned {ret}. You may need to manually correct "
-                              f"this problem.")
-        # Download those packages.
-        logger.info("Downloading packages...")
-        temp_download_dir = tempfile.mkdtemp(prefix="abcross-download-")
-        download_args = ["install", "--download-only", "-yy", "-o", "Dir::Cache::archives=/root"]
-        download_args.extend(packages)
-        _, _, ret = self.apt_call(
-            download_args,
-            containerize=True,
-            interactive=True,
-            nspawn_args=[
-                f"--bind={temp_download_dir}:/root",
-            ])
-        if ret != 0:
-            raise OSError(f"Cannot retrieve packages from the sysroot. Apt returned {ret}.")
-        debs_iter = PosixPath(temp_download_dir).iterdir()
-        debs = [deb.resolve() for deb in debs_iter if deb.name.endswith(".deb")]
-        if len(debs) == 0:
-            logger.warning(f"Requested to install {len(packages)} but apt downloaded 0 packages.")
-            logger.warning(f"This is because some packages might have already been unpacked into this sysroot before.")
-            logger.debug(f"Requested packages: {packages}")
-            return None
-        # Now unpack stuff over
-        logger.info("Unpacking packages...")
-        dpkg_call = [
-            "--force-architecture",  # We are almost certainly going to see some exotic packages...
-            "--force-depends", "--force-depends-version",  # Screw dependencies
-            "--no-triggers",
-            "--unpack",
-        ]
-        dpkg_call.extend(debs)
-        _, _, ret = self.dpkg_call(dpkg_call, containerize=False, sudo=True)
-        if ret != 0:
-            raise OSError(f"Cannot unpack packages into the sysroot. Dpkg returned {ret}.")
-        # Get rid of installed packages
-        logger.info("Cleaning up...")
-        _, _, ret = privileged_call(["rm", "-rf", temp_download_dir], interactive=False)
-        if ret != 0:
-            raise OSError(f"Cannot remove temporary download directory {temp_download_dir}")
+                raise OSError(f"Cannot resolve packages in the sysroot. Apt returned {ret}:\n{err}")
+            downloads = _parse_print_uris(out)
+            logger.info("Downloading packages...")
+            # Each download is silent, parallel ones would fight over the progress line. Count packages instead.
+            progress = Progress("Downloading packages", "Done", total=len(downloads))
+            try:
+                with ThreadPoolExecutor(max_workers=_fetch_threads()) as executor:
+                    futures = [executor.submit(download_tarball,
+                                               uri,
+                                               os.path.join(temp_download_dir, name),
+                                               digest,
+                                               # Debs are far too small for ranged downloads to pay for a HEAD each
+                                               segments=1,
+                                               silent=True,
+                                               algorithm=algorithm)
+                               for uri, name, algorithm, digest in downloads]
+                    for count_done, future in enumerate(as_completed(futures), 1):
+                        future.result()
+                        progress.update(count_done)
+            except Exception as e:
+                raise OSError(f"Cannot retrieve packages from the sysroot: {e}") from e
+            progress.update(len(downloads), final=True)
+            # temp_download_dir is already absolute. scandir gives us names without a stat or path object per entry.
+            with os.scandir(temp_download_dir) as entries:
+                debs = [entry.path for entry in entries if entry.name.endswith(".deb")]
+            if len(debs) == 0:
+                logger.warning("Requested to install %d but apt downloaded 0 packages.", len(packages))
+                logger.warning("This is because some packages might have already been unpacked into this sysroot "
+                               "before.")
+                logger.debug("Requested packages: %s", packages)
+                return None
+            # Now unpack stuff over. All debs go to one dpkg invocation: dpkg holds an exclusive lock on the admin dir,
+            # so several dpkg processes unpacking into the same sysroot in parallel would just fail on the lock.
+            logger.info("Unpacking packages...")
+            dpkg_call = [
+                "--force-architecture",  # We are almost certainly going to see some exotic packages...
+                "--force-unsafe-io",  # No fsync per file. A half unpacked sysroot is redeployed anyway.
+                "--force-depends", "--force-depends-version",  # Screw dependencies
+                "--no-triggers",
+                "--unpack",
+            ]
+            dpkg_call.extend(debs)
+            _, _, ret = self.dpkg_call(dpkg_call, containerize=False, sudo=True)
+            if ret != 0:
+                raise OSError(f"Cannot unpack packages into the sysroot. Dpkg returned {ret}.")
+            logger.info("Cleaning up...")
@@ -1,62 +1,412 @@
 import hashlib
 import logging
+import os
 import subprocess
-from pathlib import PosixPath
-from typing import List
-from urllib.request import urlopen
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, BinaryIO
+from urllib.request import urlopen, Request
+
+from .common import privileged_prefix
 
 logger = logging.getLogger("tar")
 
+# Paths are taken as anything os.fspath() accepts and turned into str once on entry. Everything past that point is
+# plain string and os calls, without a new path object per join or an __fspath__ call per argv build.
+StrPath = str | os.PathLike
 
-def download_tarball(url: str, dest_file: PosixPath, sha256sum: str | None) -> None:
-    """Download a file at specific url to a specific path and verify sha256sum if provided"""
-    checksumming = hashlib.sha256()
-    count_bytes = 0
-    with urlopen(url) as incoming, open(dest_file, "wb") as save:
-        length = 1024 * 1024
-        print("Downloading...", end='\r')
-        while True:
-            buf = incoming.read(length)
-            if not buf:
-                break
-            count_bytes += len(buf)
-            print(f"Downloading... Bytes: {count_bytes}", end='\r')
-            save.write(buf)
+# Bytes moved per read. hashlib's SHA-256 is backed by OpenSSL, which dispatches to SHA-NI / ARMv8 crypto extensions
+# where the CPU has them. Large chunks keep it in that accelerated inner loop with few Python-level calls per GiB.
+CHUNK_SIZE = 4 * 1024 * 1024
+# Number of parallel byte ranges download_tarball splits a large download into by default
+RANGE_SEGMENTS = 4
+# Files smaller than this are not worth the extra connections of a ranged download
+MIN_RANGED_SIZE = 64 * 1024 * 1024
+# Minimum seconds between two redraws of a progress line
+PROGRESS_INTERVAL = 0.1
+
+
+class Progress:
+    """
+    Single line progress report on stdout. However often it is updated, the line is redrawn at most once every
+    PROGRESS_INTERVAL seconds. Byte counts come with average throughput, counts of a known total with the total.
+    """
+
+    def __init__(self, label: str, unit: str, total: int | None = None):
+        self._label = label
+        self._unit = unit
+        self._total = total
+        self._start = self._last = time.monotonic()
+        self._width = 0
+        sys.stdout.write(f"{label}...\r")
+        sys.stdout.flush()
+
+    def update(self, count: int, final: bool = False) -> None:
+        now = time.monotonic()
+        if not final and now - self._last < PROGRESS_INTERVAL:
+            return
+        self._last = now
+        line = f"{self._label}... {self._unit}: {count}"
+        if self._total is not None:
+            line += f"/{self._total}"
+        if self._unit == "Bytes" and now > self._start:
+            line += f" ({count / (now - self._start) / (1024 * 1024):.1f} MiB/s)"
+        # Pad to blank out leftovers of a longer previous line
+        self._width = max(self._width, len(line))
+        sys.stdout.write(line.ljust(self._width) + ("\n" if final else "\r"))
+        sys.stdout.flush()
+
+
+def _checksum_error(expected: str, actual: str) -> RuntimeError:
+    return RuntimeError("Downloaded file has wrong checksum!\n"
+                        f"Expected: {expected}\n"
+                        f"Got:      {actual}"
+                        )
+
+
+def download_tarball(url: str, dest_file: StrPath, sha256sum: str | None, segments: int = RANGE_SEGMENTS,
+                     silent: bool = False, algorithm: str = "sha256") -> None:
+    """
+    Download a file at specific url to a specific path and verify sha256sum if provided. With another hashlib
+    algorithm given, sha256sum is the hex digest of that algorithm instead.
+
+    Large files on HTTP servers supporting byte ranges are fetched as several ranges over parallel connections, which
+    gets around per-connection throughput limits. Otherwise the file is downloaded in one stream.
+    With silent, nothing is printed and completion is only logged at debug level, so that callers downloading many
+    files at once can report progress on their own.
+    """
+    dest_file = os.fspath(dest_file)
+    length = _ranged_length(url) if segments > 1 and url.startswith(("http://", "https://")) else None
+    if length is not None and length >= MIN_RANGED_SIZE:
+        try:
+            _download_ranged(url, dest_file, length, segments, silent)
+        except _RangeNotHonored:
+            logger.debug("Server ignored range request for %s. Downloading in a single stream.", url)
+        else:
             if sha256sum is not None:
-                checksumming.update(buf)
-        logger.info(f"Tarball downloaded to {dest_file}. Written {count_bytes} bytes.")
-    # Verify checksum
-    if sha256sum is not None and checksumming.hexdigest() != sha256sum:
-        dest_file.unlink(missing_ok=True)
-        raise RuntimeError("Downloaded file has wrong checksum!\n"
-                           f"Expected: {sha256sum}\n"
-                           f"Got:      {checksumming.hexdigest()}"
-                           )
-
-
-def extract_tarball(tarball: PosixPath, extract_dir: PosixPath, silent=True) -> None:
+                actual = _file_digest(dest_file, algorithm)
+                if actual != sha256sum:
+                    _discard(dest_file)
+                    raise _checksum_error(sha256sum, actual)
+            return
+    count_bytes = 0
+    # Reuse a single buffer for every chunk instead of allocating a fresh bytes object per read
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open_tarball_stream(url, sha256sum, algorithm) as incoming, open(dest_file, "wb") as save:
+        _preallocate(save.fileno(), incoming.length)
+        progress = Progress("Downloading", "Bytes") if not silent else None
+        try:
+            while n := incoming.readinto(buf):
+                count_bytes += n
+                if progress is not None:
+                    progress.update(count_bytes)
+                save.write(view[:n])
+        except RuntimeError:
+            _discard(dest_file)
+            raise
+        if progress is not None:
+            progress.update(count_bytes, final=True)
+        # Don't leave preallocated blocks past the end if the server sent less than it announced
+        save.truncate(count_bytes)
+        logger.log(logging.DEBUG if silent else logging.INFO,
+                   "Tarball downloaded to %s. Written %d bytes.", dest_file, count_bytes)
+
+
+class _RangeNotHonored(Exception):
+    """Server replied to a range request with something other than the requested range"""
+    pass
+
+
+def _ranged_length(url: str) -> int | None:
+    """Return size of the file at url if the server advertises byte range support, None otherwise"""
+    try:
+        with urlopen(Request(url, method="HEAD")) as head:
+            if head.headers.get("Accept-Ranges") != "bytes":
+                return None
+            return int(head.headers.get("Content-Length"))
+    except (OSError, TypeError, ValueError):
+        # Let the single stream download report whatever is wrong with this url
+        return None
+
+
+def _download_ranged(url: str, dest_file: str, length: int, segments: int, silent: bool) -> None:
+    """Download file of length bytes at url as a number of byte ranges in parallel, each written at its offset"""
+    segment_size = -(-length // segments)
+    ranges = [(lo, min(lo + segment_size, length)) for lo in range(0, length, segment_size)]
+    count_bytes = 0
+    count_lock = threading.Lock()
+    # Set once a range fails, telling the others to give up instead of downloading a file that is thrown away
+    failed = threading.Event()
+
+    def fetch(lo: int, hi: int) -> None:
+        nonlocal count_bytes
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        offset = lo
+        with urlopen(Request(url, headers={"Range": f"bytes={lo}-{hi - 1}"})) as incoming:
+            if incoming.status != 206:
+                raise _RangeNotHonored()
+            while offset < hi and not failed.is_set() and (n := incoming.readinto(view[:min(CHUNK_SIZE, hi - offset)])):
+                written = 0
+                while written < n:
+                    written += os.pwrite(fd, view[written:n], offset + written)
+                offset += n
+                with count_lock:
+                    count_bytes += n
+                    if progress is not None:
+                        progress.update(count_bytes)
+        if offset != hi and not failed.is_set():
+            raise OSError(f"Range {lo}-{hi - 1} of {url} ended early at {offset}")
+
+    fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _preallocate(fd, length)
+        progress = Progress("Downloading", "Bytes") if not silent else None
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch, lo, hi) for lo, hi in ranges]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                failed.set()
+                for future in futures:
+                    future.cancel()
+                raise
+        if progress is not None:
+            progress.update(count_bytes, final=True)
+    except BaseException:
+        _discard(dest_file)
+        raise
+    finally:
+        os.close(fd)
+    logger.log(logging.DEBUG if silent else logging.INFO,
+               "Tarball downloaded to %s in %d ranges. Written %d bytes.", dest_file, len(ranges), count_bytes)
+
+
+def _discard(path: str) -> None:
+    """Remove a file if it is there"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _preallocate(fd: int, length: int | None) -> None:
+    """
+    Reserve length bytes of disk space for fd if length is known, so that the file doesn't have to be extended and
+    its metadata updated with every write. Filesystems not supporting this are left alone.
+    """
+    if length is None:
+        return
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except OSError:
+        pass
+
+
+def _file_digest(path: str, algorithm: str) -> str:
+    """Checksum a file on disk"""
+    checksumming = hashlib.new(algorithm)
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            checksumming.update(view[:n])
+    return checksumming.hexdigest()
+
+
+class _DigestReader:
+    """
+    Read-only file-like wrapper that checksums everything read through it and verifies the sum at EOF.
+    Checksum is updated chunk by chunk as data passes through so the content never needs to be read a second time.
+    """
+
+    def __init__(self, raw: BinaryIO, expected: str | None, algorithm: str = "sha256"):
+        self._raw = raw
+        self._expected = expected
+        self._checksumming = hashlib.new(algorithm)
+
+    def _verify(self) -> None:
+        if self._expected is not None and self._checksumming.hexdigest() != self._expected:
+            raise _checksum_error(self._expected, self._checksumming.hexdigest())
+
+    def read(self, size: int = -1) -> bytes:
+        buf = self._raw.read(size)
+        if not buf:
+            self._verify()
+        elif self._expected is not None:
+            self._checksumming.update(buf)
+        return buf
+
+    def readinto(self, b: bytearray | memoryview) -> int:
+        n = self._raw.readinto(b)
+        if not n:
+            self._verify()
+        elif self._expected is not None:
+            self._checksumming.update(memoryview(b)[:n])
+        return n
+
+    @property
+    def length(self) -> int | None:
+        """Size of the content as announced by the server, or None if unknown"""
+        try:
+            return int(self._raw.headers["Content-Length"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    def close(self) -> None:
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_tarball_stream(url: str, sha256sum: str | None, algorithm: str = "sha256") -> BinaryIO:
+    """
+    Open a file at specific url for streaming. Reading past EOF raises RuntimeError if sha256sum is provided and
+    the content does not match. With another hashlib algorithm given, sha256sum is a digest of that algorithm.
+    """
+    return _DigestReader(urlopen(url), sha256sum, algorithm)
+
+
+def open_local_tarball_stream(tarball: StrPath, sha256sum: str | None) -> BinaryIO:
+    """
+    Open a local tarball for streaming. Same as open_tarball_stream, the content is verified as it is read.
+    """
+    return _DigestReader(open(tarball, "rb"), sha256sum)
+
+
+def _decompress_args(tarball_name: str) -> List[str]:
+    """Return tar option for decompressing a tarball, guessed from its file name"""
+    match os.path.splitext(tarball_name)[1]:
+        case ".xz" | ".txz":
+            # Let xz decode blocks on all cores. Release tarballs are large enough for this to pay off.
+            return ["-I", "xz -T0"]
+        case ".gz" | ".tgz":
+            return ["-z"]
+        case ".bz2":
+            return ["-j"]
+        case ".zst":
+            return ["--zstd"]
+        case _:
+            return []
+
+
+def extract_tarball_stream(stream: BinaryIO, tarball_name: str, extract_dir: StrPath, silent=True,
+                           save_as: StrPath | None = None) -> None:
+    """
+    Extract a tarball while it is being read from stream. tarball_name is used to tell the compression format.
+
+    If save_as is given the tarball is also written there as it passes by, so that downloading, saving and
+    extracting all overlap. The file only shows up at save_as once the whole tarball has been extracted without error.
+    Otherwise the tarball is not saved anywhere.
+    """
+    extract_dir = os.fspath(extract_dir)
+    _check_extract_dir(extract_dir)
+    tar_command: List[str] = [*privileged_prefix(), "tar", "-x", *_decompress_args(tarball_name), "-f", "-",
+                              "-p", "--xattrs", "-C", extract_dir]
+    save_as = os.fspath(save_as) if save_as is not None else None
+    partial = save_as + ".part" if save_as is not None else None
+    save = open(partial, "wb") if partial is not None else None
+    if save is not None:
+        _preallocate(save.fileno(), getattr(stream, "length", None))
+    # tar stdout is not read here: a full stdout pipe would stall tar while we block on writing its stdin.
+    extract = subprocess.Popen(tar_command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    count_bytes = 0
+    progress = Progress("Extracting", "Bytes") if not silent else None
+    try:
+        try:
+            tar_reading = True
+            while buf := stream.read(CHUNK_SIZE):
+                count_bytes += len(buf)
+                if progress is not None:
+                    progress.update(count_bytes)
+                if tar_reading:
+                    try:
+                        extract.stdin.write(buf)
+                    except BrokenPipeError:
+                        # tar quit early. Its exit status tells what went wrong, but the stream is still read to
+                        # the end: the checksum is only verified at EOF, and an early exit must not skip it.
+                        tar_reading = False
+                if save is not None:
+                    save.write(buf)
+            try:
+                extract.stdin.close()
+            except BrokenPipeError:
+                pass
+        except BaseException:
+            extract.kill()
+            extract.wait()
+            raise
+        result = extract.wait()
+        if progress is not None:
+            progress.update(count_bytes, final=True)
+        logger.debug("Expanded archive. Read %d bytes.", count_bytes)
+        if result != 0:
+            raise OSError(f"tar returned non zero exit status {result}")
+    except BaseException:
+        if save is not None:
+            save.close()
+            _discard(partial)
+        raise
+    if save is not None:
+        save.truncate(count_bytes)
+        save.close()
+        os.replace(partial, save_as)
+        logger.info("Tarball saved to %s. Written %d bytes.", save_as, count_bytes)
+
+
+def _check_extract_dir(extract_dir: str) -> None:
+    """Refuse to extract anywhere but into an existing empty directory"""
+    if not os.path.isdir(extract_dir):
+        raise ValueError("Destination sysroot is not a directory")
+    with os.scandir(extract_dir) as entries:
+        if next(entries, None) is not None:
+            raise ValueError("Destination sysroot is not empty. Refusing to overwrite.")
+
+
+def extract_tarball(tarball: StrPath, extract_dir: StrPath, silent=True) -> None:
+    """
+    Extract a tarball on disk into an empty directory.
+
+    deploy streams tarballs through extract_tarball_stream and does not use this. It is kept as library API, the
+    counterpart of get_tarball and get_tarballs for callers that download tarballs first and extract them later.
+    """
+    tarball = os.fspath(tarball)
+    extract_dir = os.fspath(extract_dir)
     # Sanity checks
-    if not tarball.exists() or not tarball.is_file():
+    if not os.path.isfile(tarball):
         raise ValueError("Tarball doesn't exist or is not a regular file")
-    if not extract_dir.exists() or not extract_dir.is_dir():
-        raise ValueError("Destination sysroot is not a directory")
-    if next(extract_dir.iterdir(), None) is not None:
-        raise ValueError("Destination sysroot is not empty. Refusing to overwrite.")
+    _check_extract_dir(extract_dir)
+    decompress_args = _decompress_args(os.path.basename(tarball))
     # Yeah, I ain't doing this in a pythonic way...
-    tar_command: List[str] = ["sudo", "tar", "-xavf", tarball, "-px", "--xattrs", "-C", extract_dir]
-    extract = subprocess.Popen(tar_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if silent:
+        # Nobody is watching. Don't have tar list files at all.
+        tar_command: List[str] = [*privileged_prefix(), "tar", "-x", *decompress_args, "-f", tarball,
+                                  "-p", "--xattrs", "-C", extract_dir]
+        result = subprocess.run(tar_command, stdout=subprocess.DEVNULL).returncode
+        logger.debug("Expanded archive.")
+        if result != 0:
+            raise OSError(f"tar returned non zero exit status {result}")
+        return
+    tar_command: List[str] = [*privileged_prefix(), "tar", "-xv", *decompress_args, "-f", tarball,
+                              "-p", "--xattrs", "-C", extract_dir]
+    extract = subprocess.Popen(tar_command, stdout=subprocess.PIPE)
     count_files = 0
-    error_out = ""
-    if not silent:
-        print("Extracting... Written Files:", end='\r')
-    while extract.poll() is None:
-        out = extract.stdout.readline()
-        count_files += len(out.splitlines())
-        if not silent and count_files > 0:
-            print(f"Extracting... Written Files: {count_files}", end='\r')
-    result = extract.poll()
-    if not silent:
-        print()
-    logger.debug(f"Expanded archive. Written {count_files} files.")
+    progress = Progress("Extracting", "Written Files")
+    # tar prints one line per file. Count newlines in raw blocks rather than decoding and splitting lines.
+    while out := os.read(extract.stdout.fileno(), 65536):
+        count_files += out.count(b"\n")
+        progress.update(count_files)
+    extract.stdout.close()
+    result = extract.wait()
+    progress.update(count_files, final=True)
+    logger.debug("Expanded archive. Written %d files.", count_files)
     if result != 0:
         raise OSError(f"tar returned non zero exit status {result}")
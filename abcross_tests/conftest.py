@@ -0,0 +1,44 @@
+import io
+import tarfile
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+
+def _make_tarball(path, trailing: int = 0) -> None:
+    """Write a small uncompressed tarball, optionally followed by garbage past its end-of-archive blocks"""
+    with tarfile.open(path, "w") as tar:
+        content = b"hello\n"
+        info = tarfile.TarInfo("hello.txt")
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    with open(path, "ab") as f:
+        f.write(b"\0" * trailing)
+
+
+@pytest.fixture
+def make_tarball():
+    return _make_tarball
+
+
+@pytest.fixture
+def http_server():
+    """
+    Start threaded HTTP servers on localhost, shut down after the test. Call with a handler class and attributes to
+    set on the server, which is where handlers find their content and keep their counters.
+    """
+    servers = []
+
+    def start(handler, **attributes) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        for name, value in attributes.items():
+            setattr(server, name, value)
+        Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,25 @@
+import pytest
+
+from abcross.common import Architecture
+
+
+class TestArchitecture:
+    @pytest.mark.parametrize("arch", list(Architecture))
+    def test_every_architecture_has_qemu_mapping(self, arch: Architecture):
+        assert arch.qemu_bin() == f"qemu-{arch.qemu_arch()}-static"
+
+    @pytest.mark.parametrize(
+        "arch, expect_qemu_arch",
+        [
+            (Architecture.AMD64, "amd64"),
+            (Architecture.ARM64, "aarch64"),
+            (Architecture.LOONGSON3, "mips64el"),
+            (Architecture.ARMV7HF, "arm"),
+            (Architecture.I486, "i386"),
+        ]
+    )
+    def test_qemu_arch(self, arch: Architecture, expect_qemu_arch: str):
+        assert arch.qemu_arch() == expect_qemu_arch
+
+    def test_standard_sysroot(self):
+        assert str(Architecture.RISCV64.standard_sysroot()) == "/var/ab/cross-root/riscv64"
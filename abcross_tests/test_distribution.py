@@ -1,10 +1,36 @@
+import json
+import os
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler
 from types import NoneType
 from typing import Type
 
 import pytest
 
-from abcross.distribution import Variant, get_release_tarball_info, get_manifest
+from abcross.distribution import Variant, get_release_tarball_info, get_manifest, do_deploy, _fetch_and_extract
 from abcross.common import Architecture
+from abcross.sysroot import Sysroot
+
+
+class ManifestHandler(BaseHTTPRequestHandler):
+    """Serves server.manifest with an ETag, answering 304 to a matching If-None-Match"""
+    etag = '"v1"'
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == self.etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.manifest).encode()
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
 class TestDistribution:
@@ -103,6 +129,23 @@ class TestDistribution:
         if actual is not None:
             assert actual["sha256sum"] == expect_sha256
 
+    def test_get_release_tarball_info_skips_unknown_entries(self):
+        manifest = {
+            "variants": [
+                {"name": "Some Future Variant", "tarballs": []},
+                {
+                    "name": "Base",
+                    "tarballs": [
+                        {"arch": "some-future-arch", "date": "20230101", "sha256sum": "unknown"},
+                        {"arch": "amd64", "date": "20220508", "sha256sum": "known"},
+                    ]
+                },
+            ]
+        }
+        actual = get_release_tarball_info(manifest, Architecture.AMD64, Variant.BASE)
+        assert actual is not None
+        assert actual["sha256sum"] == "known"
+
     @pytest.mark.parametrize("mirror, expect_raise",
                              [
                                  ("https://repo.aosc.io", NoneType),
@@ -118,3 +161,76 @@ class TestDistribution:
             actual = e
 
         assert type(actual) == expect_raise
+
+    def test_get_manifest_file_mirror(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("abcross.distribution.CACHE_DIR", tmp_path / "cache")
+        manifest_dir = tmp_path / "aosc-os" / "manifest"
+        manifest_dir.mkdir(parents=True)
+        (manifest_dir / "recipe.json").write_text(json.dumps(TestDistribution.test_manifest_valid))
+        actual = get_manifest(f"file://{tmp_path}/")
+        assert actual == TestDistribution.test_manifest_valid
+        # Nothing is cached unless asked for
+        assert not (tmp_path / "cache").exists()
+
+    @pytest.mark.skipif(os.geteuid() != 0, reason="extraction runs tar as root")
+    def test_corrupted_cached_tarball_is_dropped(self, tmp_path, monkeypatch, make_tarball):
+        cache_dir = tmp_path / "cache"
+        cache_dir.mkdir()
+        monkeypatch.setattr("abcross.distribution.CACHE_DIR", cache_dir)
+        # Garbage past the end-of-archive blocks lets tar finish long before the checksum is known
+        cached = cache_dir / "t.tar"
+        make_tarball(cached, trailing=16 * 1024 * 1024)
+        sysroot = Sysroot(Architecture.AMD64, tmp_path / "sysroot")
+        sysroot.path.mkdir()
+        args = Namespace(cache=True, mirror="file:///nonexistent/")
+        tarball = {"path": "os-amd64/t.tar", "sha256sum": "0" * 64}
+        with pytest.raises(RuntimeError):
+            _fetch_and_extract(sysroot, args, tarball)
+        assert not cached.exists()
+        assert not sysroot.path.exists()
+
+    def test_get_manifest_not_modified(self, tmp_path, monkeypatch, http_server):
+        monkeypatch.setattr("abcross.distribution.CACHE_DIR", tmp_path)
+        server = http_server(ManifestHandler, manifest=TestDistribution.test_manifest_valid, not_modified=0)
+        mirror = f"http://127.0.0.1:{server.server_port}/"
+        assert get_manifest(mirror, cache=True) == TestDistribution.test_manifest_valid
+        assert server.not_modified == 0
+        # Second time around the cached copy is revalidated and served
+        assert get_manifest(mirror, cache=True) == TestDistribution.test_manifest_valid
+        assert server.not_modified == 1
+        # Nothing but the manifest and its etag is left in the cache
+        assert sorted(p.suffix for p in tmp_path.iterdir()) == [".etag", ".json"]
+
+    def test_get_manifest_broken_cache(self, tmp_path, monkeypatch, http_server):
+        monkeypatch.setattr("abcross.distribution.CACHE_DIR", tmp_path)
+        server = http_server(ManifestHandler, manifest=TestDistribution.test_manifest_valid, not_modified=0)
+        mirror = f"http://127.0.0.1:{server.server_port}/"
+        get_manifest(mirror, cache=True)
+        [cached] = tmp_path.glob("*.json")
+        cached.write_text("{ truncated")
+        # The 304 points at a cache that can't be read. The manifest is downloaded again instead.
+        assert get_manifest(mirror, cache=True) == TestDistribution.test_manifest_valid
+        assert server.not_modified == 1
+        assert json.loads(cached.read_text()) == TestDistribution.test_manifest_valid
+
+    def test_failed_stale_removal_reported_when_deploy_fails(self, tmp_path, monkeypatch, caplog):
+        sysroot = Sysroot(Architecture.AMD64, tmp_path / "sysroot")
+        sysroot.path.mkdir()
+        (sysroot.path / "old").touch()
+
+        def fake_privileged_python(snippet, argv, interactive=False):
+            # Preparing the sysroot works, removing the stale one in the background does not
+            return ("", "", 0) if len(argv) == 2 else ("", "", 1)
+
+        def failing_fetch(s, args, tarball):
+            raise RuntimeError("download failed")
+
+        monkeypatch.setattr("abcross.distribution.get_manifest", lambda mirror, cache=False: {})
+        monkeypatch.setattr("abcross.distribution.get_release_tarball_info",
+                            lambda manifest, arch, variant: {"date": "1", "downloadSize": 1, "instSize": 1})
+        monkeypatch.setattr("abcross.distribution.privileged_python", fake_privileged_python)
+        monkeypatch.setattr("abcross.distribution._fetch_and_extract", failing_fetch)
+        args = Namespace(mirror="file:///nonexistent/", variant=Variant.BUILDKIT, force=True, cache=False)
+        with pytest.raises(RuntimeError):
+            do_deploy(sysroot, args)
+        assert "Cannot delete old sysroot" in caplog.text
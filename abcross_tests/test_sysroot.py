@@ -0,0 +1,151 @@
+import hashlib
+import os
+import socket
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler
+from pathlib import PosixPath
+
+import pytest
+
+from abcross.common import Architecture
+from abcross.sysroot import Sysroot, APT_LISTS_MAX_AGE, FETCH_THREADS, _UPDATE_STAMP, _fetch_threads, _parse_print_uris
+
+
+class TestSysroot:
+    def test_apt_lists_fresh(self, tmp_path):
+        sysroot = Sysroot(Architecture.AMD64, tmp_path)
+        # A staging directory alone does not count, failed updates leave it behind too
+        (tmp_path / "var/lib/apt/lists/partial").mkdir(parents=True)
+        assert not sysroot.apt_lists_fresh()
+        stamp = tmp_path / _UPDATE_STAMP
+        stamp.touch()
+        assert sysroot.apt_lists_fresh()
+        stale = time.time() - APT_LISTS_MAX_AGE - 1
+        os.utime(stamp, (stale, stale))
+        assert not sysroot.apt_lists_fresh()
+
+    @staticmethod
+    def write_sources(sysroot_dir, uri: str) -> None:
+        (sysroot_dir / "etc/apt/sources.list.d").mkdir(parents=True)
+        (sysroot_dir / "etc/apt/sources.list").write_text(f"deb {uri} stable main\n")
+
+    def test_inrelease_validators(self, tmp_path, http_server):
+        repo = tmp_path / "repo"
+        (repo / "dists/stable").mkdir(parents=True)
+        (repo / "dists/stable/InRelease").write_text("release\n")
+        server = http_server(partial(SimpleHTTPRequestHandler, directory=repo))
+        uri = f"http://127.0.0.1:{server.server_port}/"
+        self.write_sources(tmp_path / "sysroot", uri)
+        validators = Sysroot(Architecture.AMD64, tmp_path / "sysroot")._inrelease_validators()
+        assert list(validators) == [f"{uri}dists/stable/InRelease"]
+
+    def test_inrelease_validators_timeout(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("abcross.sysroot.VALIDATOR_TIMEOUT", 0.2)
+        # Accepts connections but never answers
+        with socket.create_server(("127.0.0.1", 0)) as silent:
+            self.write_sources(tmp_path, f"http://127.0.0.1:{silent.getsockname()[1]}/")
+            assert Sysroot(Architecture.AMD64, tmp_path)._inrelease_validators() is None
+
+    def test_host_apt_call(self, tmp_path, monkeypatch):
+        calls = []
+
+        def fake_call(argv, interactive):
+            # The configuration file only lives for the duration of the call
+            apt_config = argv[1].removeprefix("APT_CONFIG=")
+            calls.append((argv, PosixPath(apt_config).read_text()))
+            return "", "", 0
+
+        monkeypatch.setattr("abcross.sysroot.regular_call", fake_call)
+        root = str(tmp_path)
+        Sysroot(Architecture.AMD64, tmp_path).apt_call(["install", "bash"], containerize=False, sudo=False)
+        [(argv, apt_config)] = calls
+        assert argv[0] == "env" and argv[1].startswith("APT_CONFIG=") and argv[2] == "apt"
+        options = [argv[i + 1] for i, arg in enumerate(argv) if arg == "-o"]
+        assert f"Dir={root}/" in options
+        assert f"Dir::Etc={root}/etc/apt/" in options
+        assert f"Dir::State::status={root}/var/lib/dpkg/status" in options
+        assert f"Dir::Cache={root}/var/cache/apt/" in options
+        assert argv[-2:] == ["install", "bash"]
+        # Read by apt before its configuration parts, so that those of the host are never read
+        assert f'Dir "{root}/";' in apt_config
+        assert f'Dir::Etc "{root}/etc/apt/";' in apt_config
+
+
+class TestUnpack:
+    @pytest.mark.parametrize("value, expect", [(None, FETCH_THREADS), ("3", 3), ("0", FETCH_THREADS),
+                                               ("many", FETCH_THREADS)])
+    def test_fetch_threads(self, monkeypatch, value: str | None, expect: int):
+        if value is None:
+            monkeypatch.delenv("ABCROSS_FETCH_THREADS", raising=False)
+        else:
+            monkeypatch.setenv("ABCROSS_FETCH_THREADS", value)
+        assert _fetch_threads() == expect
+
+    def test_packages_cached_in_sysroot_are_unpacked(self, tmp_path, monkeypatch):
+        sysroot_dir = tmp_path / "sysroot"
+        (sysroot_dir / "var/lib/dpkg").mkdir(parents=True)
+        (sysroot_dir / "var/lib/apt").mkdir(parents=True)
+        # Fresh lists, so no container is needed for a refresh
+        (sysroot_dir / _UPDATE_STAMP).touch()
+        cached_archives = sysroot_dir / "var/cache/apt/archives"
+        cached_archives.mkdir(parents=True)
+        (cached_archives / "hello_1.0_arm64.deb").write_bytes(b"deb")
+        (tmp_path / "hello_1.0_arm64.deb").write_bytes(b"deb")
+        unpacked = []
+
+        def fake_apt_call(self, argv, **kwargs):
+            # Like apt, leave out debs already complete in the archives directory
+            options = [argv[i + 1] for i, arg in enumerate(argv) if arg == "-o"]
+            archives = next((o.removeprefix("Dir::Cache::archives=") for o in options
+                             if o.startswith("Dir::Cache::archives=")), cached_archives)
+            if (PosixPath(archives) / "hello_1.0_arm64.deb").exists():
+                return "", "", 0
+            uri = (tmp_path / "hello_1.0_arm64.deb").as_uri()
+            return f"'{uri}' hello_1.0_arm64.deb 3 SHA256:{hashlib.sha256(b'deb').hexdigest()}\n", "", 0
+
+        def fake_dpkg_call(self, argv, **kwargs):
+            unpacked.extend(os.path.basename(arg) for arg in argv if arg.endswith(".deb"))
+            return "", "", 0
+
+        monkeypatch.setattr(Sysroot, "apt_call", fake_apt_call)
+        monkeypatch.setattr(Sysroot, "dpkg_call", fake_dpkg_call)
+        Sysroot(Architecture.ARM64, sysroot_dir).unpack(["hello"])
+        assert unpacked == ["hello_1.0_arm64.deb"]
+
+    @pytest.mark.parametrize("ret", [1, 127, -9])
+    def test_apt_script_failure(self, tmp_path, monkeypatch, ret: int):
+        (tmp_path / "var/lib/dpkg").mkdir(parents=True)
+        monkeypatch.setattr(Sysroot, "containerize", lambda self, argv, interactive: ("", "", ret))
+        monkeypatch.setattr(Sysroot, "apt_call", lambda self, argv, **kwargs: pytest.fail("resolved packages"))
+        with pytest.raises(OSError):
+            Sysroot(Architecture.ARM64, tmp_path).unpack(["hello"], force_update=True)
+
+
+class TestParsePrintUris:
+    uri = "https://repo.aosc.io/debs/pool/stable/main/b/bash_5.2.15-0_amd64.deb"
+
+    @pytest.mark.parametrize(
+        "hash_field, expect_algorithm",
+        [
+            ("SHA512:" + "ab" * 64, "sha512"),
+            ("SHA256:" + "AB" * 32, "sha256"),
+        ]
+    )
+    def test_supported_hash(self, hash_field: str, expect_algorithm: str):
+        out = f"'{self.uri}' bash_5.2.15-0_amd64.deb 1441640 {hash_field}\n"
+        [(uri, name, algorithm, digest)] = _parse_print_uris(out)
+        assert (uri, name, algorithm) == (self.uri, "bash_5.2.15-0_amd64.deb", expect_algorithm)
+        assert digest == hash_field.split(":")[1].lower()
+
+    @pytest.mark.parametrize("hash_field", ["MD5Sum:" + "ab" * 16, "SHA1:" + "ab" * 20, ""])
+    def test_unsupported_hash(self, hash_field: str):
+        with pytest.raises(OSError):
+            _parse_print_uris(f"'{self.uri}' bash_5.2.15-0_amd64.deb 1441640 {hash_field}\n")
+
+    def test_garbage(self):
+        with pytest.raises(OSError):
+            _parse_print_uris("W: Something unexpected\n")
+
+    def test_empty(self):
+        assert _parse_print_uris("") == []
@@ -0,0 +1,138 @@
+import hashlib
+import os
+from http.server import BaseHTTPRequestHandler
+from urllib.error import HTTPError
+
+import pytest
+
+from abcross.tar import download_tarball, open_local_tarball_stream, extract_tarball_stream
+
+needs_root = pytest.mark.skipif(os.geteuid() != 0, reason="extraction runs tar as root")
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves server.content at every path, honoring byte ranges if server.honor_range is set"""
+
+    def do_HEAD(self):
+        self.send_content(head=True)
+
+    def do_GET(self):
+        self.send_content()
+
+    def send_content(self, head: bool = False):
+        content = self.server.content
+        body = content
+        requested = self.headers.get("Range")
+        if requested is not None and self.server.honor_range:
+            self.server.ranges_served += 1
+            lo, hi = map(int, requested.removeprefix("bytes=").split("-"))
+            if lo > 0 and self.server.fail_later_ranges:
+                self.send_error(500)
+                return
+            body = content[lo:hi + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {lo}-{hi}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def range_server(monkeypatch, http_server):
+    # Small enough for the content below to take the ranged path
+    monkeypatch.setattr("abcross.tar.MIN_RANGED_SIZE", 1)
+    return http_server(RangeHandler, content=os.urandom(1024 * 1024 + 7), honor_range=True, ranges_served=0,
+                       fail_later_ranges=False)
+
+
+class TestDownloadTarball:
+    def test_ranged(self, tmp_path, range_server):
+        url = f"http://127.0.0.1:{range_server.server_port}/t.tar"
+        download_tarball(url, tmp_path / "dest", hashlib.sha256(range_server.content).hexdigest(), segments=4)
+        assert (tmp_path / "dest").read_bytes() == range_server.content
+        assert range_server.ranges_served == 4
+
+    def test_range_ignored(self, tmp_path, range_server):
+        range_server.honor_range = False
+        url = f"http://127.0.0.1:{range_server.server_port}/t.tar"
+        download_tarball(url, tmp_path / "dest", hashlib.sha256(range_server.content).hexdigest(), segments=4)
+        assert (tmp_path / "dest").read_bytes() == range_server.content
+
+    def test_ranged_failure(self, tmp_path, range_server):
+        range_server.fail_later_ranges = True
+        url = f"http://127.0.0.1:{range_server.server_port}/t.tar"
+        with pytest.raises(HTTPError):
+            download_tarball(url, tmp_path / "dest", hashlib.sha256(range_server.content).hexdigest(), segments=4)
+        assert not (tmp_path / "dest").exists()
+
+    def test_ranged_wrong_checksum(self, tmp_path, range_server):
+        url = f"http://127.0.0.1:{range_server.server_port}/t.tar"
+        with pytest.raises(RuntimeError):
+            download_tarball(url, tmp_path / "dest", "0" * 64, segments=4)
+        assert not (tmp_path / "dest").exists()
+
+    def test_wrong_checksum(self, tmp_path):
+        source = tmp_path / "source"
+        source.write_bytes(b"deb")
+        with pytest.raises(RuntimeError):
+            download_tarball(source.as_uri(), tmp_path / "dest", "0" * 64)
+        assert not (tmp_path / "dest").exists()
+
+    def test_silent(self, tmp_path, capsys):
+        source = tmp_path / "source"
+        source.write_bytes(b"deb")
+        download_tarball(source.as_uri(), tmp_path / "dest", hashlib.sha256(b"deb").hexdigest(), silent=True)
+        assert (tmp_path / "dest").read_bytes() == b"deb"
+        assert capsys.readouterr().out == ""
+
+
+class TestTarballStream:
+    def test_wrong_checksum(self, tmp_path):
+        tarball = tmp_path / "t.tar"
+        tarball.write_bytes(b"not what was expected")
+        with open_local_tarball_stream(tarball, "0" * 64) as stream:
+            assert stream.read(4) == b"not "
+            with pytest.raises(RuntimeError):
+                while stream.read(4):
+                    pass
+
+    def test_sha512(self, tmp_path):
+        tarball = tmp_path / "t.tar"
+        tarball.write_bytes(b"content")
+        url = tarball.as_uri()
+        download_tarball(url, tmp_path / "dest", hashlib.sha512(b"content").hexdigest(), algorithm="sha512")
+        assert (tmp_path / "dest").read_bytes() == b"content"
+
+
+@needs_root
+class TestExtractTarballStream:
+    # More than a chunk and a pipe buffer, so tar is done and gone long before the stream ends
+    trailing = 16 * 1024 * 1024
+
+    def test_extract(self, tmp_path, make_tarball):
+        tarball = tmp_path / "t.tar"
+        make_tarball(tarball)
+        (tmp_path / "out").mkdir()
+        with open_local_tarball_stream(tarball, None) as stream:
+            extract_tarball_stream(stream, "t.tar", tmp_path / "out", save_as=tmp_path / "saved.tar")
+        assert (tmp_path / "out" / "hello.txt").read_bytes() == b"hello\n"
+        assert (tmp_path / "saved.tar").read_bytes() == tarball.read_bytes()
+
+    @pytest.mark.parametrize("save", [False, True])
+    def test_wrong_checksum_with_trailing_data(self, tmp_path, make_tarball, save: bool):
+        tarball = tmp_path / "t.tar"
+        make_tarball(tarball, trailing=self.trailing)
+        (tmp_path / "out").mkdir()
+        save_as = tmp_path / "saved.tar" if save else None
+        with pytest.raises(RuntimeError):
+            with open_local_tarball_stream(tarball, "0" * 64) as stream:
+                extract_tarball_stream(stream, "t.tar", tmp_path / "out", save_as=save_as)
+        assert not (tmp_path / "saved.tar").exists()
+        assert not (tmp_path / "saved.tar.part").exists()